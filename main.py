@@ -1,7 +1,15 @@
+import io
+import re
+import time
 import streamlit as st
 import yfinance as yf
 import pandas as pd
-from datetime import datetime
+import numpy as np
+import diskcache
+from scipy import stats
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 st.set_page_config(page_title="Stock Analysis Dashboard", layout="wide")
 
@@ -25,191 +33,311 @@ market_risk_premium = 0.06
 assumed_eps_growth = 0.21
 assumed_cost_of_debt = 0.08
 
+NI_RE = re.compile(r"net\s*income", re.I)
+CFO_RE = re.compile(r"operating.*activities", re.I)
 
-@st.cache_data(ttl=3600)
-def fetch_stock_data():
-    results = []
-
-    for name, symbol in tickers.items():
-        try:
-            stock = yf.Ticker(symbol)
-            info = stock.info
-            financials = stock.financials
-            cashflow = stock.cashflow
-
-            net_income = None
-            cfo = None
-
-            for label in financials.index:
-                if "net income" in label.lower():
-                    ni_series = financials.loc[label].dropna()
-                    if not ni_series.empty:
-                        net_income = ni_series.iloc[0]
-                        break
-
-            for label in cashflow.index:
-                if "operating" in label.lower() and "activities" in label.lower():
-                    cfo_series = cashflow.loc[label].dropna()
-                    if not cfo_series.empty:
-                        cfo = cfo_series.iloc[0]
-                        break
-
-            earnings_quality = cfo >= net_income if net_income and cfo else None
-
-            roe = info.get("returnOnEquity")
-            pe_ratio = info.get("trailingPE")
-            industry_pe = info.get("forwardPE")
-            pb_ratio = info.get("priceToBook")
-            de_ratio = info.get("debtToEquity")
-            dividend_yield = info.get("dividendYield")
-            market_cap = info.get("marketCap")
-            current_price = info.get("currentPrice")
-            beta = info.get("beta", 1.0)
-
-            cost_of_equity = risk_free_rate + beta * market_risk_premium
-            peg_ratio = (pe_ratio / (assumed_eps_growth * 100)) if (pe_ratio and assumed_eps_growth) else None
-            roe_percent = roe * 100 if roe else None
-            roe_spread = roe_percent - (cost_of_equity * 100) if roe_percent else None
-
-            ebit = info.get("ebit") or info.get("ebitda")
-            tax_rate = info.get("taxRate", 0.25)
-
-            nopat = ebit * (1 - tax_rate) if ebit else None
-            total_debt = info.get("totalDebt", 0)
-            total_equity = info.get("totalStockholderEquity", 0)
-            invested_capital = total_debt + total_equity
-
-            roic = (nopat / invested_capital) * 100 if nopat and invested_capital else None
-
-            equity_weight = total_equity / invested_capital if invested_capital else 0
-            debt_weight = total_debt / invested_capital if invested_capital else 0
-            wacc = (equity_weight * cost_of_equity) + (
-                        debt_weight * assumed_cost_of_debt * (1 - tax_rate)) if invested_capital else None
-            roic_spread = roic - (wacc * 100) if roic and wacc else None
-
-            results.append({
-                "Company": name,
-                "P/E": pe_ratio,
-                "Industry P/E": industry_pe,
-                "PEG": peg_ratio,
-                "ROE (%)": roe_percent,
-                "CoE (%)": cost_of_equity * 100,
-                "ROE - CoE (%)": roe_spread,
-                "ROIC (%)": roic,
-                "WACC (%)": wacc * 100 if wacc else None,
-                "ROIC - WACC (%)": roic_spread,
-                "P/B": pb_ratio,
-                "D/E": de_ratio,
-                "Dividend Yield (%)": dividend_yield * 100 if dividend_yield else None,
-                "Market Cap (₹ Cr)": market_cap / 1e7 if market_cap else None,
-                "Price (₹)": current_price,
-                "Earnings Quality (CFO ≥ Net Profit)": "✔" if earnings_quality else "✖" if earnings_quality is not None else "N/A",
-                "Earnings Quality Score": 1 if earnings_quality else 0 if earnings_quality is not None else None
-            })
-
-        except Exception as e:
-            st.warning(f"Error fetching data for {name}: {e}")
-
-    return pd.DataFrame(results)
-
-
-df = fetch_stock_data()
-
-if df.empty:
-    st.error("Failed to fetch stock data.")
-    st.stop()
+INFO_KEYS = (
+    "returnOnEquity", "trailingPE", "forwardPE", "priceToBook", "debtToEquity", "dividendYield",
+    "marketCap", "currentPrice", "beta", "ebit", "ebitda", "taxRate", "totalDebt", "totalStockholderEquity"
+)
 
-scored_df = df.copy()
+ASCENDING_COLS = ("PEG", "P/E", "P/B", "D/E")
+DESCENDING_COLS = ("ROE - CoE (%)", "ROIC - WACC (%)", "Dividend Yield (%)")
 
-for col in ["PEG", "P/E", "P/B", "D/E"]:
-    scored_df[f"{col}_score"] = scored_df[col].rank(ascending=True)
+DISPLAY_COLS = (
+    "Rank", "Company", "P/E", "Industry P/E", "PEG", "ROE (%)", "CoE (%)", "ROE - CoE (%)",
+    "ROIC (%)", "WACC (%)", "ROIC - WACC (%)",
+    "P/B", "D/E", "Dividend Yield (%)", "Earnings Quality (CFO ≥ Net Profit)", "Market Cap (₹ Cr)", "Price (₹)"
+)
 
-for col in ["ROE - CoE (%)", "ROIC - WACC (%)", "Dividend Yield (%)"]:
-    scored_df[f"{col}_score"] = scored_df[col].rank(ascending=False)
 
-scored_df["Earnings Quality Score_score"] = scored_df["Earnings Quality Score"]
+@st.cache_resource
+def get_disk_cache():
+    return diskcache.Cache(Path(__file__).parent / ".stockcache")
+
+
+def _first_value(frame, pattern):
+    """Return the latest non-null value of the first row whose label matches ``pattern``."""
+    if frame is None or frame.empty:
+        return None
+    matches = frame.loc[frame.index.str.contains(pattern)]
+    has_value = matches.notna().to_numpy().any(axis=1)
+    if not has_value.any():
+        return None
+    row = matches.iloc[has_value.argmax()]
+    return row[row.first_valid_index()]
 
-scored_df["Total Score"] = (
-    scored_df[[col for col in scored_df.columns if col.endswith("_score")]].sum(axis=1)
-)
 
-scored_df = scored_df[scored_df["Total Score"].notna()].copy()
-scored_df["Rank"] = scored_df["Total Score"].rank(method="min").astype("Int64")
-scored_df = scored_df.sort_values("Rank")
+def _extract_raw(name, info, financials, cashflow):
+    """Pull the raw inputs for one company out of already-fetched data."""
+    net_income = _first_value(financials, NI_RE)
+    cfo = _first_value(cashflow, CFO_RE)
 
-display_cols = [
-    "Rank", "Company", "P/E", "Industry P/E", "PEG", "ROE (%)", "CoE (%)", "ROE - CoE (%)",
-    "ROIC (%)", "WACC (%)", "ROIC - WACC (%)",
-    "P/B", "D/E", "Dividend Yield (%)", "Earnings Quality (CFO ≥ Net Profit)", "Market Cap (₹ Cr)", "Price (₹)"
-]
+    raw = {key: info.get(key) for key in INFO_KEYS}
+    raw.update(Company=name, net_income=net_income, cfo=cfo)
+    return raw
 
-st.dataframe(scored_df[display_cols].set_index("Rank"), use_container_width=True)
 
-st.subheader("\U0001F4CC Factor Scoring Explanation")
-explanation = pd.DataFrame([
-    {"Factor": "PEG", "Ideal": "< 1", "Explanation": "Lower PEG indicates undervaluation relative to growth."},
-    {"Factor": "P/E", "Ideal": "Low vs industry", "Explanation": "Lower P/E suggests better value."},
-    {"Factor": "Industry P/E", "Ideal": "—", "Explanation": "For comparison with company P/E."},
-    {"Factor": "P/B", "Ideal": "Low", "Explanation": "Lower P/B indicates potential undervaluation."},
-    {"Factor": "D/E", "Ideal": "< 1", "Explanation": "Lower D/E means lower financial risk."},
-    {"Factor": "ROE - CoE (%)", "Ideal": "> 0", "Explanation": "ROE above CoE indicates value creation."},
-    {"Factor": "ROIC - WACC (%)", "Ideal": "> 0", "Explanation": "ROIC exceeding WACC indicates true value creation."},
-    {"Factor": "Dividend Yield (%)", "Ideal": "> 1%",
-     "Explanation": "Higher yield is attractive for income investors."},
-    {"Factor": "Earnings Quality (CFO ≥ Net Profit)", "Ideal": "✔",
-     "Explanation": "Good earnings quality when operating cash ≥ reported net income. Scoring: 1 if true, 0 otherwise."}
-])
-
-st.dataframe(explanation, use_container_width=True)
-
-
-def generate_summary(row):
+def _fetch_one(item):
+    """Fetch one ``(name, symbol)`` pair and return ``(raw, error)``.
+
+    Runs inside a worker thread, so it must not call any ``st.*`` API; errors
+    are returned to the caller instead of being reported here.
+    """
+    name, symbol = item
+    try:
+        stock = yf.Ticker(symbol)
+        return _extract_raw(name, stock.info, stock.financials, stock.cashflow), None
+    except Exception as e:
+        return None, (name, e)
+
+
+def _derive_metrics(raw):
+    """Compute the dashboard columns for every company in one vectorized pass.
+
+    Missing inputs are NaN and propagate through the arithmetic, so a metric is
+    NaN whenever any of its inputs is unavailable.
+    """
+    raw = raw.set_index("Company").apply(pd.to_numeric, errors="coerce")
+
+    cost_of_equity = risk_free_rate + raw["beta"].fillna(1.0) * market_risk_premium
+    roe_percent = raw["returnOnEquity"] * 100
+
+    tax_rate = raw["taxRate"].fillna(0.25)
+    nopat = raw["ebit"].fillna(raw["ebitda"]) * (1 - tax_rate)
+    total_debt = raw["totalDebt"].fillna(0)
+    total_equity = raw["totalStockholderEquity"].fillna(0)
+    invested_capital = (total_debt + total_equity).replace(0, np.nan)
+
+    roic = nopat / invested_capital * 100
+    wacc = (total_equity / invested_capital * cost_of_equity
+            + total_debt / invested_capital * assumed_cost_of_debt * (1 - tax_rate))
+
+    has_quality = raw["net_income"].notna() & raw["cfo"].notna()
+    earnings_quality = raw["cfo"] >= raw["net_income"]
+
+    return pd.DataFrame({
+        "P/E": raw["trailingPE"],
+        "Industry P/E": raw["forwardPE"],
+        "PEG": raw["trailingPE"] / (assumed_eps_growth * 100),
+        "ROE (%)": roe_percent,
+        "CoE (%)": cost_of_equity * 100,
+        "ROE - CoE (%)": roe_percent - cost_of_equity * 100,
+        "ROIC (%)": roic,
+        "WACC (%)": wacc * 100,
+        "ROIC - WACC (%)": roic - wacc * 100,
+        "P/B": raw["priceToBook"],
+        "D/E": raw["debtToEquity"],
+        "Dividend Yield (%)": raw["dividendYield"] * 100,
+        "Market Cap (₹ Cr)": raw["marketCap"] / 1e7,
+        "Price (₹)": raw["currentPrice"],
+        "Earnings Quality (CFO ≥ Net Profit)": np.where(
+            has_quality, np.where(earnings_quality, "✔", "✖"), "N/A"),
+        "Earnings Quality Score": earnings_quality.astype(float).where(has_quality),
+    }).reset_index()
+
+
+def _download_stock_data():
+    cols = defaultdict(list)
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=min(8, len(tickers))) as executor:
+        for raw, error in executor.map(_fetch_one, tickers.items()):
+            if raw is None:
+                errors.append(error)
+                continue
+            for key, value in raw.items():
+                cols[key].append(value)
+
+    for name, e in errors:
+        st.warning(f"Error fetching data for {name}: {e}")
+
+    if not cols:
+        return pd.DataFrame(), errors
+    df = _derive_metrics(pd.DataFrame(cols))
+    df["Fetched At"] = pd.Timestamp.now()
+    return df, errors
+
+
+def _current_bucket():
+    return int(time.time() // 3600)
+
+
+def _last_good_key():
+    return "stocks", tuple(sorted(tickers.values()))
+
+
+def _cache_key(bucket):
+    return *_last_good_key(), bucket
+
+
+def _persist(bucket, df):
+    payload = df.to_parquet()
+    disk_cache = get_disk_cache()
+    disk_cache.set(_cache_key(bucket), payload, expire=3600)
+    disk_cache.set(_last_good_key(), payload)
+
+
+def fetch_stock_data(bucket):
+    hit = get_disk_cache().get(_cache_key(bucket))
+    if hit is not None:
+        return pd.read_parquet(io.BytesIO(hit))
+
+    df, errors = _download_stock_data()
+    # Only complete results are persisted; a partial frame would otherwise
+    # survive restarts with the failed companies silently missing.
+    if not df.empty and not errors:
+        _persist(bucket, df)
+    elif df.empty:
+        last_good = get_disk_cache().get(_last_good_key())
+        if last_good is not None:
+            df = pd.read_parquet(io.BytesIO(last_good))
+            st.warning(f"Could not fetch fresh data; showing the last successful fetch "
+                       f"from {df['Fetched At'].iloc[0]:%Y-%m-%d %H:%M}.")
+    return df
+
+
+@st.cache_data
+def get_explanation():
+    return pd.DataFrame([
+        {"Factor": "PEG", "Ideal": "< 1", "Explanation": "Lower PEG indicates undervaluation relative to growth."},
+        {"Factor": "P/E", "Ideal": "Low vs industry", "Explanation": "Lower P/E suggests better value."},
+        {"Factor": "Industry P/E", "Ideal": "—", "Explanation": "For comparison with company P/E."},
+        {"Factor": "P/B", "Ideal": "Low", "Explanation": "Lower P/B indicates potential undervaluation."},
+        {"Factor": "D/E", "Ideal": "< 1", "Explanation": "Lower D/E means lower financial risk."},
+        {"Factor": "ROE - CoE (%)", "Ideal": "> 0", "Explanation": "ROE above CoE indicates value creation."},
+        {"Factor": "ROIC - WACC (%)", "Ideal": "> 0", "Explanation": "ROIC exceeding WACC indicates true value creation."},
+        {"Factor": "Dividend Yield (%)", "Ideal": "> 1%",
+         "Explanation": "Higher yield is attractive for income investors."},
+        {"Factor": "Earnings Quality (CFO ≥ Net Profit)", "Ideal": "✔",
+         "Explanation": "Good earnings quality when operating cash ≥ reported net income. Scoring: 1 if true, 0 otherwise."}
+    ])
+
+
+def summary_flags(frame):
+    """Evaluate every summary rule as a boolean mask over the whole frame."""
+    return pd.DataFrame({
+        "company": frame["Company"],
+        "rank": frame["Rank"],
+        "peg_ok": frame["PEG"] < 1,
+        "roe_ok": frame["ROE - CoE (%)"] > 0,
+        "roic_ok": frame["ROIC - WACC (%)"] > 0,
+        "de_ok": frame["D/E"] < 1,
+        "dy_ok": frame["Dividend Yield (%)"] > 1,
+        "eq": frame["Earnings Quality (CFO ≥ Net Profit)"],
+    })
+
+
+@st.cache_data
+def render_row_md(company, rank, peg_ok, roe_ok, roic_ok, de_ok, dy_ok, eq):
     positives = []
     cautions = []
 
-    if row['PEG'] is not None and row['PEG'] < 1:
+    if peg_ok:
         positives.append("✔ PEG < 1")
     else:
         cautions.append("⚠ PEG ≥ 1 or unavailable")
 
-    if row['ROE - CoE (%)'] is not None and row['ROE - CoE (%)'] > 0:
+    if roe_ok:
         positives.append("✔ ROE exceeds Cost of Equity")
     else:
         cautions.append("⚠ ROE ≤ CoE")
 
-    if row['ROIC - WACC (%)'] is not None and row['ROIC - WACC (%)'] > 0:
+    if roic_ok:
         positives.append("✔ ROIC exceeds WACC")
     else:
         cautions.append("⚠ ROIC ≤ WACC")
 
-    if row['D/E'] is not None and row['D/E'] < 1:
+    if de_ok:
         positives.append("✔ Low Debt-to-Equity")
     else:
         cautions.append("⚠ High Debt")
 
-    if row['Dividend Yield (%)'] is not None and row['Dividend Yield (%)'] > 1:
+    if dy_ok:
         positives.append("✔ Healthy Dividend Yield")
 
-    if row["Earnings Quality (CFO ≥ Net Profit)"] == "✔":
+    if eq == "✔":
         positives.append("✔ Strong Earnings Quality (CFO ≥ Net Profit)")
-    elif row["Earnings Quality (CFO ≥ Net Profit)"] == "✖":
+    elif eq == "✖":
         cautions.append("⚠ Weak Earnings Quality (CFO < Net Profit)")
 
-    return positives, cautions
+    md = f"### {company} (Rank {rank})\n\n**✅ Positives:**\n\n" + "".join(f"- {p}\n" for p in positives)
+    if cautions:
+        md += "\n**⚠ Cautions:**\n\n" + "".join(f"- {c}\n" for c in cautions)
+    return md
 
 
-st.subheader("\U0001F4DD Summary & Caution for Each Company")
-for i, row in scored_df.iterrows():
-    st.markdown(f"### {row['Company']} (Rank {row['Rank']})")
-    positives, cautions = generate_summary(row)
+def rank_stocks(df):
+    scored_df = df.copy()
 
-    st.markdown("**✅ Positives:**")
-    for pos in positives:
-        st.markdown(f"- {pos}")
+    mat = np.column_stack([
+        scored_df[list(ASCENDING_COLS)].to_numpy(dtype=np.float64),
+        -scored_df[list(DESCENDING_COLS)].to_numpy(dtype=np.float64),
+    ])
+    scores = np.column_stack([
+        stats.rankdata(mat, axis=0, nan_policy="omit"),
+        scored_df["Earnings Quality Score"].to_numpy(dtype=np.float64),
+    ])
+    scored_df["Total Score"] = np.nansum(scores, axis=1)
+    scored_df = scored_df.loc[~np.all(np.isnan(scores), axis=1)].copy()
+    scored_df["Rank"] = scored_df["Total Score"].rank(method="min").astype("Int64")
+    return scored_df.sort_values("Rank")
 
-    if cautions:
-        st.markdown("**⚠ Cautions:**")
-        for c in cautions:
-            st.markdown(f"- {c}")
 
-st.caption(f"\U0001F504 Last updated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+class NoStockDataError(RuntimeError):
+    pass
+
+
+@st.cache_data(ttl=3600)
+def build_report(bucket):
+    """Rank and summarize the data for the hour ``bucket``.
+
+    Keying on the bucket makes the in-process entry expire with the DiskCache
+    key it was read from, so the two TTLs never stack.
+    """
+    df = fetch_stock_data(bucket)
+    if df.empty:
+        # Raising keeps the failure out of st.cache_data, so the next rerun retries.
+        raise NoStockDataError("Failed to fetch stock data.")
+
+    scored_df = rank_stocks(df)
+    summaries = [render_row_md(*row) for row in summary_flags(scored_df).itertuples(index=False)]
+    return scored_df, summaries
+
+
+def refresh_stock_data():
+    """Download now, replacing the cached data only if every ticker succeeded."""
+    df, errors = _download_stock_data()
+    if df.empty or errors:
+        st.warning("Refresh failed; still showing the previously fetched data.")
+        return
+
+    _persist(_current_bucket(), df)
+    build_report.clear()
+
+
+if st.button("\U0001F504 Refresh"):
+    refresh_stock_data()
+
+try:
+    scored_df, summaries = build_report(_current_bucket())
+except NoStockDataError as e:
+    st.error(str(e))
+    st.stop()
+
+display_df = scored_df[list(DISPLAY_COLS)].set_index("Rank")
+numeric_cols = display_df.select_dtypes(include="number").columns
+display_df = display_df.astype({
+    **dict.fromkeys(numeric_cols, np.float32),
+    "Company": "string",
+    "Earnings Quality (CFO ≥ Net Profit)": "string",
+})
+st.dataframe(display_df, use_container_width=True)
+
+st.subheader("\U0001F4CC Factor Scoring Explanation")
+st.dataframe(get_explanation(), use_container_width=True)
+
+st.subheader("\U0001F4DD Summary & Caution for Each Company")
+st.markdown("\n\n".join(summaries))
+
+st.caption(f"\U0001F504 Last updated: {scored_df['Fetched At'].iloc[0]:%Y-%m-%d %H:%M:%S}")